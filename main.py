@@ -1,9 +1,17 @@
 
+import io
 import re
+from functools import lru_cache
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import streamlit as st
 import plotly.express as px
+import plotly.graph_objects as go
+
+# Copy-on-Write: recortes filtrados viram views preguiçosas (já é o padrão a partir do pandas 3)
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.options.mode.copy_on_write = True
 
 st.set_page_config(page_title="Dashboard Consultórios", layout="wide")
 
@@ -20,52 +28,70 @@ section[data-testid="stSidebar"] {background-color:#f5f7fb}
 st.title("🏥 Dashboard de Ocupação dos Consultórios")
 st.caption("Lendo somente as abas **CONSULTÓRIO** (ignorando 'OCUPAÇÃO DAS SALAS'). Integra automaticamente TODAS as abas **MÉDICOS** (ex.: 'MÉDICOS 1', 'MÉDICOS 2', 'MÉDICOS 3').")
 
+# calamine (Rust) lê só os valores das células; sem ele o leitor openpyxl do pandas já abre em read_only/data_only
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
+
 DEFAULT_PATH = Path("/mnt/data/ESCALA DOS CONSULTORIOS DEFINITIVO.xlsx")
+# o cache por arquivo guarda só as últimas planilhas (bytes e frames derivados)
+MAX_WORKBOOKS = 2
 
 # ---------- Sidebar: Upload ----------
 st.sidebar.header("📂 Fonte de Dados")
 uploaded = st.sidebar.file_uploader("Envie o Excel (.xlsx)", type=["xlsx"], key="main_xlsx")
 
-def load_excel(file_like):
-    try:
-        return pd.ExcelFile(file_like)
-    except Exception as e:
-        st.error(f"Não foi possível abrir o arquivo: {e}")
-        return None
-
-excel = None
+# Os bytes do arquivo são a chave dos caches: reruns por interação reaproveitam os DataFrames já processados
 if uploaded is not None:
-    excel = load_excel(uploaded)
+    payload = uploaded.getvalue()
     fonte = "Upload do usuário"
 elif DEFAULT_PATH.exists():
-    excel = load_excel(DEFAULT_PATH)
+    payload = DEFAULT_PATH.read_bytes()
     fonte = f"Arquivo padrão: {DEFAULT_PATH.name}"
 else:
     st.error("Nenhum arquivo encontrado. Envie um Excel com as abas de CONSULTÓRIO.")
     st.stop()
 
-st.sidebar.success(f"Usando dados de: {fonte}")
-
 # ---------- Utilitários ----------
+_ACCENT_TABLE = str.maketrans("áãâéêíîóõôúüç", "aaaeeiioooucc")
+
+# cabeçalhos se repetem entre abas (Dia, Manhã, Tarde, Médico...): depois da primeira vez é só um lookup
+@lru_cache(maxsize=4096)
 def _normalize_col(col):
-    c = str(col).strip().lower()
-    c = (c
-         .replace("á","a").replace("ã","a").replace("â","a")
-         .replace("é","e").replace("ê","e")
-         .replace("í","i").replace("î","i")
-         .replace("ó","o").replace("õ","o").replace("ô","o")
-         .replace("ú","u").replace("ü","u")
-         .replace("ç","c"))
-    c = re.sub(r"[\n\r\t]", " ", c)
-    c = re.sub(r"\s+", " ", c).strip()
-    return c
+    c = str(col).strip().lower().translate(_ACCENT_TABLE)
+    return " ".join(c.split())
+
+_DAY_RE = re.compile(r"segunda|ter[cç]a|quarta|quinta|sexta|s[aá]bado")
+_MANHA_RE = re.compile(r"manh[ãa]")
+_TARDE_RE = re.compile(r"tarde")
+
+def _header_names(row):
+    # mesmos nomes que o pandas geraria com header=h ("Unnamed: i" e sufixos .1, .2 em duplicados,
+    # pulando sufixos que já existem no cabeçalho)
+    names = [f"Unnamed: {i}" if pd.isna(v) else v for i, v in enumerate(row)]
+    counts = {}
+    for i, name in enumerate(names):
+        cur = counts.get(name, 0)
+        col = name
+        while cur > 0:
+            counts[name] = cur + 1
+            col = f"{name}.{cur}"
+            cur = cur + 1 if col in names else counts.get(col, 0)
+        names[i] = col
+        counts[col] = cur + 1
+    return names
 
 def detect_header_and_parse(excel, sheet_name):
-    for header in [0,1,2,3,4]:
-        try:
-            df = excel.parse(sheet_name, header=header)
-        except Exception:
-            continue
+    # lê a aba uma única vez e testa cada linha candidata a cabeçalho sobre o mesmo bloco
+    try:
+        raw = excel.parse(sheet_name, header=None, dtype=object)
+    except Exception:
+        return None
+    for header in range(min(5, len(raw))):
+        df = raw.iloc[header+1:].copy()
+        df.columns = _header_names(raw.iloc[header].tolist())
         df = df.dropna(how="all").dropna(axis=1, how="all")
         if df.empty:
             continue
@@ -75,16 +101,16 @@ def detect_header_and_parse(excel, sheet_name):
 
         for i, cn in enumerate(cols_norm):
             if col_dia is None:
-                if "dia" in cn or any(d in cn for d in ["segunda","terca","terça","quarta","quinta","sexta","sabado","sábado"]):
+                if "dia" in cn or _DAY_RE.search(cn):
                     col_dia = df.columns[i]
-            if any(k in cn for k in ["manha","manhã"]): col_manha = df.columns[i]
-            if "tarde" in cn: col_tarde = df.columns[i]
+            if _MANHA_RE.search(cn): col_manha = df.columns[i]
+            if _TARDE_RE.search(cn): col_tarde = df.columns[i]
 
         # fallback: primeira coluna contém dias
         if col_dia is None and len(df.columns) >= 1:
             first_col = df.columns[0]
             sample = df[first_col].astype(str).str.lower()
-            if sample.str.contains("segunda|terca|terça|quarta|quinta|sexta|sabado|sábado").any():
+            if sample.str.contains(_DAY_RE).any():
                 col_dia = first_col
 
         if col_dia is not None and (col_manha is not None or col_tarde is not None):
@@ -99,59 +125,282 @@ def detect_header_and_parse(excel, sheet_name):
             return df
     return None
 
-def tidy_from_sheets(excel):
-    frames = []
-    for sheet in excel.sheet_names:
-        s_norm = _normalize_col(sheet)
-        if ("consult" in s_norm) and ("ocupa" not in s_norm):
-            df = detect_header_and_parse(excel, sheet)
-            if df is None or df.empty:
-                continue
-            df["Dia"] = (df["Dia"].astype(str).str.strip()
-                         .str.replace("terca","terça", case=False)
-                         .str.replace("sabado","sábado", case=False)
-                         .str.capitalize())
-            df.insert(0, "Sala", sheet.strip())
-            long = df.melt(id_vars=["Sala","Dia"], value_vars=[c for c in ["Manhã","Tarde"] if c in df.columns],
-                           var_name="Turno", value_name="Médico")
-            long["Médico"] = long["Médico"].astype(str).replace({"nan":"","None":""}).str.strip()
-            frames.append(long)
+def _parse_consult(excel, sheet):
+    df = detect_header_and_parse(excel, sheet)
+    if df is None or df.empty:
+        return None
+    df.insert(0, "Sala", sheet.strip())
+    return df
+
+def _finalize_consult(frames):
     if not frames:
         return pd.DataFrame(columns=["Sala","Dia","Turno","Médico"])
-    full = pd.concat(frames, ignore_index=True)
+    # concatena as abas ainda no formato largo e faz um único melt
+    wide = pd.concat(frames, ignore_index=True)
+    wide["Dia"] = (wide["Dia"].astype(str).str.strip()
+                   .str.replace("terca","terça", case=False)
+                   .str.replace("sabado","sábado", case=False)
+                   .str.capitalize())
+    value_vars = [c for c in ["Manhã","Tarde"] if c in wide.columns]
+    full = wide.melt(id_vars=["Sala","Dia"], value_vars=value_vars, var_name="Turno", value_name="Médico")
+    # abas sem um dos turnos não geram slots para ele
+    tamanhos = [len(f) for f in frames]
+    tem_turno = np.concatenate([np.repeat([t in f.columns for f in frames], tamanhos) for t in value_vars])
+    # o melt sai turno a turno; ordenação estável pela aba devolve a ordem por consultório (Manhã, depois Tarde)
+    aba = np.tile(np.repeat(np.arange(len(frames)), tamanhos), len(value_vars))
+    ordem = np.argsort(aba, kind="stable")
+    full = full.iloc[ordem[tem_turno[ordem]]].reset_index(drop=True)
+    # strip e isin rodam nos kernels do Arrow
+    med = full["Médico"].astype("string[pyarrow]").str.strip()
+    full["Médico"] = med.mask(med.isna() | med.isin(["nan","None","NaN","<NA>"]), "")
     full["Dia"] = pd.Categorical(full["Dia"], categories=["Segunda","Terça","Quarta","Quinta","Sexta","Sábado"], ordered=True)
-    full["Ocupado"] = full["Médico"].str.len() > 0
+    # string vazia é False: ocupação vira um bool de 1 byte sem passar por str.len
+    full["Ocupado"] = full["Médico"].to_numpy().astype(bool)
+    # filtros, isin e groupby passam a operar sobre códigos inteiros
+    for c in ("Sala","Turno","Médico"):
+        full[c] = full[c].astype("category")
     return full
 
-df = tidy_from_sheets(excel)
+# ---------- Integração das abas MÉDICOS (1, 2, 3...) ----------
+def _to_number(s: pd.Series) -> pd.Series:
+    txt = s.astype(str).str.replace(r"[^\d,.-]", "", regex=True)
+    # com vírgula, ela é o separador decimal e os pontos são milhar
+    has_comma = txt.str.contains(",", regex=False)
+    txt = txt.where(~has_comma, txt.str.replace(".", "", regex=False).str.replace(",", ".", regex=False))
+    return pd.to_numeric(txt, errors="coerce")
+
+def _medico_field(c):
+    field = None
+    if "nome" in c or "medico" in c: field="Médico"
+    if c=="crm" or "crm" in c: field="CRM"
+    if "especial" in c: field="Especialidade"
+    if "planos" in c or c=="plano": field="Planos"
+    if "valor" in c or "aluguel" in c or "negoci" in c: field="Valor Aluguel"
+    if "exclus" in c: field="Sala Exclusiva"
+    if "divid" in c: field="Sala Dividida"
+    return field
+
+def _parse_medico(excel, sheet):
+    # descarta as colunas fora do mapeamento já no parse (o pandas ainda lê a aba inteira)
+    try:
+        dfm = excel.parse(sheet, header=0, usecols=lambda c: _medico_field(_normalize_col(c)) is not None)
+    except Exception:
+        return None
+    if dfm is None or dfm.empty:
+        return None
+    dfm = dfm.rename(columns={c: _medico_field(_normalize_col(c)) for c in dfm.columns})
+    keep = [c for c in ["Médico","CRM","Especialidade","Planos","Sala Exclusiva","Sala Dividida","Valor Aluguel"] if c in dfm.columns]
+    if not keep:
+        return None
+    return dfm[keep].copy()
+
+def _finalize_medico(frames):
+    if not frames:
+        return pd.DataFrame()
+    out = pd.concat(frames, ignore_index=True)
+    # normalizações finais
+    if "Médico" in out.columns: out["Médico"] = out["Médico"].astype(str).str.strip()
+    if "Planos" in out.columns: out["Planos"] = out["Planos"].astype(str).str.strip().astype("category")
+    if "Especialidade" in out.columns: out["Especialidade"] = out["Especialidade"].astype("category")
+    if "Valor Aluguel" in out.columns: out["Valor Aluguel"] = _to_number(out["Valor Aluguel"])
+    for c in ["Sala Exclusiva","Sala Dividida"]:
+        if c in out.columns:
+            out[c] = out[c].astype(str).str.strip().str.upper().replace({"X":"Sim","":""})
+    return out
+
+def load_all(excel: pd.ExcelFile):
+    # uma só varredura das abas, despachando CONSULTÓRIO e MÉDICOS pelo nome
+    consult, medic = [], []
+    for s in excel.sheet_names:
+        sn = _normalize_col(s)
+        if ("consult" in sn) and ("ocupa" not in sn):
+            long = _parse_consult(excel, s)
+            if long is not None:
+                consult.append(long)
+        if "medic" in sn:  # captura "médicos", "medicos"
+            dfm = _parse_medico(excel, s)
+            if dfm is not None:
+                medic.append(dfm)
+    return _finalize_consult(consult), _finalize_medico(medic)
+
+# ---------- Leitura: PRODUTIVIDADE CONSULTÓRIO e CONSULTAS MARCADAS ----------
+def load_produtividade_from_excel(excel: pd.ExcelFile):
+    frames = []
+    for s in excel.sheet_names:
+        sn = _normalize_col(s)
+        if "produtividade" in sn and "consultorio" in sn:
+            # Tenta ler com header na primeira linha
+            try:
+                dfp = excel.parse(s, header=0)
+            except Exception:
+                continue
+            if dfp is None or dfp.empty:
+                continue
+
+            # Normaliza colunas
+            norm_map = {c: _normalize_col(c) for c in dfp.columns}
+            dfp.columns = [norm_map[c] for c in dfp.columns]
+
+            rename = {}
+            for c in dfp.columns:
+                if "nome" in c: rename[c] = "NOME"
+                elif c == "crm" or "crm" in c: rename[c] = "CRM"
+                elif "especial" in c: rename[c] = "ESPECIALIDADE"
+                elif "exame" in c: rename[c] = "EXAMES SOLICITADOS"
+                elif "cirurg" in c: rename[c] = "CIRURGIAS SOLICITADAS"
+            dfp = dfp.rename(columns=rename)
+
+            keep = [c for c in ["NOME","CRM","ESPECIALIDADE","EXAMES SOLICITADOS","CIRURGIAS SOLICITADAS"] if c in dfp.columns]
+            if not keep:
+                continue
+            dfp = dfp[keep].copy()
+
+            # Tipos numéricos para métricas
+            for c in ["EXAMES SOLICITADOS","CIRURGIAS SOLICITADAS"]:
+                if c in dfp.columns:
+                    dfp[c] = pd.to_numeric(dfp[c], errors="coerce").fillna(0)
+
+            # Extrai nº do consultório do nome da aba
+            m = re.search(r"(\d+)", s)
+            consultorio = f"Consultório {m.group(1)}" if m else s
+            dfp.insert(0, "Consultório", consultorio)
+            frames.append(dfp)
+
+    if not frames:
+        return pd.DataFrame(columns=["Consultório","NOME","CRM","ESPECIALIDADE","EXAMES SOLICITADOS","CIRURGIAS SOLICITADAS"])
+    return pd.concat(frames, ignore_index=True)
+
+def load_consultas_marcadas(excel: pd.ExcelFile):
+    target_name = None
+    for s in excel.sheet_names:
+        if _normalize_col(s) == "consultas marcadas":
+            target_name = s
+            break
+    if target_name is None:
+        # tenta contém
+        for s in excel.sheet_names:
+            if "consulta" in _normalize_col(s) and "marcada" in _normalize_col(s):
+                target_name = s
+                break
+    if target_name is None:
+        return pd.DataFrame(columns=["Especialidade","Quantidade"])
+
+    dfc = excel.parse(target_name, header=0)
+    if dfc is None or dfc.empty:
+        return pd.DataFrame(columns=["Especialidade","Quantidade"])
+
+    # Normaliza colunas
+    cols_map = {c:_normalize_col(c) for c in dfc.columns}
+    dfc.columns = [cols_map[c] for c in dfc.columns]
+    rename = {}
+    for c in dfc.columns:
+        if "especial" in c: rename[c] = "Especialidade"
+        elif "quant" in c: rename[c] = "Quantidade"
+    dfc = dfc.rename(columns=rename)
+
+    keep = [c for c in ["Especialidade","Quantidade"] if c in dfc.columns]
+    if not keep:
+        return pd.DataFrame(columns=["Especialidade","Quantidade"])
+    dfc = dfc[keep].copy()
+    dfc["Quantidade"] = pd.to_numeric(dfc["Quantidade"], errors="coerce").fillna(0).astype(int)
+    dfc["Especialidade"] = dfc["Especialidade"].astype(str).str.strip()
+    dfc = dfc[dfc["Especialidade"].str.len()>0]
+    return dfc
+
+@st.cache_data(show_spinner=False, max_entries=MAX_WORKBOOKS)
+def _load_workbook_bytes(b: bytes) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    # ExcelFile local a cada chamada: o leitor calamine não é thread-safe para ser compartilhado entre sessões
+    excel = pd.ExcelFile(io.BytesIO(b), engine=EXCEL_ENGINE)
+    df, med_df = load_all(excel)
+    return df, med_df, load_produtividade_from_excel(excel), load_consultas_marcadas(excel)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _to_csv_bytes(frame: pd.DataFrame) -> bytes:
+    # hash do frame é bem mais barato que serializar: o CSV só é refeito quando o filtro muda
+    return frame.to_csv(index=False).encode("utf-8-sig")
+
+FAIXA_BINS = [0,500,1000,1500,2000,3000,9999999]
+FAIXA_LABELS = ["até 500","501–1000","1001–1500","1501–2000","2001–3000","3000+"]
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def enrich_medicos(med_df: pd.DataFrame, usos: pd.DataFrame) -> tuple[pd.DataFrame, dict]:
+    # depende só de sala/dia/turno (via usos), não do filtro de médico: reruns com os mesmos usos reaproveitam tudo
+    med_enriched = med_df.merge(usos, on="Médico", how="left")
+    cols = med_enriched.columns
+    aggs = {}
+    if "Planos" in cols:
+        aggs["cont"] = med_enriched.groupby("Planos", observed=True)["Médico"].nunique().reset_index(name="Profissionais")
+    if "Valor Aluguel" in cols and "Planos" in cols:
+        avgv = med_enriched.groupby("Planos", observed=True)["Valor Aluguel"].mean().reset_index(name="Valor médio (R$)")
+        avgv["Valor médio (R$)"] = avgv["Valor médio (R$)"].round(2)
+        aggs["avgv"] = avgv
+    if "Valor Aluguel" in cols:
+        med_enriched["Faixa Aluguel"] = pd.cut(med_enriched["Valor Aluguel"], bins=FAIXA_BINS, labels=FAIXA_LABELS, include_lowest=True)
+        aggs["dist"] = (med_enriched.groupby(["Planos","Faixa Aluguel"], observed=True, sort=False)["Médico"].nunique()
+                        .reset_index(name="Profissionais")
+                        .sort_values(["Planos","Faixa Aluguel"]))
+    if "Especialidade" in cols and "Valor Aluguel" in cols:
+        aggs["esp_avg"] = (med_enriched.groupby("Especialidade", observed=True, sort=False)["Valor Aluguel"].mean()
+                           .reset_index(name="Valor médio (R$)")
+                           .sort_values("Valor médio (R$)", ascending=False))
+    if "Planos" in cols and "Especialidade" in cols:
+        aggs["plano_esp"] = med_enriched.groupby(["Especialidade","Planos"], observed=True)["Médico"].nunique().reset_index(name="Profissionais")
+    if "Sala Exclusiva" in cols or "Sala Dividida" in cols:
+        vazio = pd.Series("", index=med_enriched.index)
+        excl = med_enriched.get("Sala Exclusiva", vazio).eq("Sim").to_numpy()
+        div = med_enriched.get("Sala Dividida", vazio).eq("Sim").to_numpy()
+        # Exclusiva tem precedência sobre Dividida
+        med_enriched["Tipo de Sala"] = np.select([excl, div], ["Exclusiva", "Dividida"], default=None)
+        ts = med_enriched.dropna(subset=["Tipo de Sala"])
+        aggs["dist_ts"] = ts.groupby("Tipo de Sala")["Médico"].nunique().reset_index(name="Profissionais")
+    return med_enriched, aggs
+
+try:
+    df, med_df, prod_df, cons_df = _load_workbook_bytes(payload)
+except Exception as e:
+    st.error(f"Não foi possível abrir o arquivo: {e}")
+    st.stop()
+
+st.sidebar.success(f"Usando dados de: {fonte}")
+
 if df.empty:
     st.error("Não foram encontrados dados nas abas 'CONSULTÓRIO'.")
     st.stop()
 
 # ---------- Filtros ----------
 st.sidebar.header("🔎 Filtros")
-salas = sorted(df["Sala"].dropna().unique().tolist())
-dias = [d for d in ["Segunda","Terça","Quarta","Quinta","Sexta","Sábado"] if d in df["Dia"].astype(str).unique()]
-turnos = sorted(df["Turno"].dropna().unique().tolist())
-medicos = sorted([m for m in df["Médico"].dropna().unique().tolist() if m])
+salas = df["Sala"].cat.categories.tolist()
+dias = df["Dia"].cat.remove_unused_categories().cat.categories.tolist()
+turnos = df["Turno"].cat.categories.tolist()
+medicos = [m for m in df["Médico"].cat.categories.tolist() if m]
 
 sel_salas = st.sidebar.multiselect("Consultório(s)", salas, default=salas)
 sel_dias = st.sidebar.multiselect("Dia(s)", dias, default=dias)
 sel_turnos = st.sidebar.multiselect("Turno(s)", turnos, default=turnos)
 sel_medicos = st.sidebar.multiselect("Médico(s)", medicos, default=[], help="Deixe vazio para não filtrar por médico.")
 
+def _cat_mask(s, values):
+    # compara os códigos inteiros da categoria, sem materializar strings
+    codes = s.cat.categories.get_indexer(values)
+    return np.isin(s.cat.codes.to_numpy(), codes[codes >= 0])
+
 # Base para KPIs (NÃO filtra por médico)
-mask_base = (df["Sala"].isin(sel_salas) & df["Dia"].astype(str).isin(sel_dias) & df["Turno"].isin(sel_turnos))
-fdf_base = df[mask_base].copy()
+mask_base = (_cat_mask(df["Sala"], sel_salas) & _cat_mask(df["Dia"], sel_dias) & _cat_mask(df["Turno"], sel_turnos))
+fdf_base = df[mask_base]
+
+# Resumo Sala × Dia × Turno (no máximo algumas centenas de linhas): KPIs e gráficos de ocupação saem dele
+agg = (fdf_base.groupby(["Sala","Dia","Turno"], observed=True, sort=False)["Ocupado"]
+       .agg(occ="sum", n="size")
+       .reset_index())
 
 # Aplicar filtro de médico apenas onde fizer sentido
-mask_medico = df["Médico"].isin(sel_medicos) if sel_medicos else True
-fdf = df[mask_base & mask_medico].copy()
+mask_medico = _cat_mask(df["Médico"], sel_medicos) if sel_medicos else True
+fdf = df[mask_base & mask_medico]
 
 # ---------- KPIs ----------
 total_salas = len(set(sel_salas))
-total_slots = len(fdf_base)
-ocupados = int(fdf_base["Ocupado"].sum())
+total_slots = int(agg["n"].sum())
+ocupados = int(agg["occ"].sum())
 tx_ocup = (ocupados / total_slots * 100) if total_slots > 0 else 0
 slots_livres = max(total_slots - ocupados, 0)
 medicos_distintos = fdf_base.loc[fdf_base["Ocupado"], "Médico"].nunique()
@@ -167,111 +416,60 @@ kc1.metric("Taxa de ocupação", f"{tx_ocup:.1f}%")
 kc2.metric("Médicos distintos (no filtro de sala/dia/turno)", medicos_distintos)
 
 # ---------- Gráficos de ocupação ----------
+def _taxa_ocupacao(dim):
+    # ordena só o resultado (poucas linhas) pela ordem das categorias: dias da semana em sequência
+    out = agg.groupby(dim, observed=True, sort=False)[["occ","n"]].sum().sort_index().reset_index()
+    out["Taxa de Ocupação (%)"] = (out["occ"] / out["n"] * 100).round(1)
+    return out
+
+# Barras simples (um x, um y, rótulo de texto) montadas direto em go.Bar, sem a resolução de layout do px
+TPL = go.Layout(margin=dict(l=40, r=10, t=40, b=40))
+TPL_PCT = go.Layout(TPL, yaxis=dict(range=[0,100]))
+
+def _bar(frame, x, y, title, texttemplate=None, horizontal=False, layout=TPL):
+    text = frame[x] if horizontal else frame[y]
+    fig = go.Figure(go.Bar(x=frame[x], y=frame[y], text=text, texttemplate=texttemplate, textposition="outside",
+                           orientation="h" if horizontal else "v",
+                           hovertemplate=f"{x}=%{{x}}<br>{y}=%{{y}}<extra></extra>"), layout=layout)
+    return fig.update_layout(title=title, xaxis_title=x, yaxis_title=y)
+
 colA, colB = st.columns(2)
 with colA:
-    by_sala = fdf_base.groupby("Sala")["Ocupado"].mean().reset_index()
-    by_sala["Taxa de Ocupação (%)"] = (by_sala["Ocupado"]*100).round(1)
-    fig1 = px.bar(by_sala, x="Sala", y="Taxa de Ocupação (%)", title="Ocupação por Consultório (%)", text="Taxa de Ocupação (%)")
-    fig1.update_traces(texttemplate="%{text:.1f}%", textposition="outside")
-    fig1.update_yaxes(range=[0,100])
+    by_sala = _taxa_ocupacao("Sala")
+    fig1 = _bar(by_sala, "Sala", "Taxa de Ocupação (%)", "Ocupação por Consultório (%)", texttemplate="%{text:.1f}%", layout=TPL_PCT)
     st.plotly_chart(fig1, use_container_width=True)
 
 with colB:
-    by_dia = fdf_base.groupby("Dia")["Ocupado"].mean().reset_index()
-    by_dia["Taxa de Ocupação (%)"] = (by_dia["Ocupado"]*100).round(1)
-    fig2 = px.bar(by_dia, x="Dia", y="Taxa de Ocupação (%)", title="Ocupação por Dia da Semana (%)", text="Taxa de Ocupação (%)")
-    fig2.update_traces(texttemplate="%{text:.1f}%", textposition="outside")
-    fig2.update_yaxes(range=[0,100])
+    by_dia = _taxa_ocupacao("Dia")
+    fig2 = _bar(by_dia, "Dia", "Taxa de Ocupação (%)", "Ocupação por Dia da Semana (%)", texttemplate="%{text:.1f}%", layout=TPL_PCT)
     st.plotly_chart(fig2, use_container_width=True)
 
 colC, colD = st.columns(2)
 with colC:
-    by_turno = fdf_base.groupby("Turno")["Ocupado"].mean().reset_index()
-    by_turno["Taxa de Ocupação (%)"] = (by_turno["Ocupado"]*100).round(1)
-    fig3 = px.bar(by_turno, x="Turno", y="Taxa de Ocupação (%)", title="Ocupação por Turno (%)", text="Taxa de Ocupação (%)")
-    fig3.update_traces(texttemplate="%{text:.1f}%", textposition="outside")
-    fig3.update_yaxes(range=[0,100])
+    by_turno = _taxa_ocupacao("Turno")
+    fig3 = _bar(by_turno, "Turno", "Taxa de Ocupação (%)", "Ocupação por Turno (%)", texttemplate="%{text:.1f}%", layout=TPL_PCT)
     st.plotly_chart(fig3, use_container_width=True)
 
 with colD:
-    top_med = (fdf[fdf["Ocupado"]]
-               .groupby("Médico")
-               .size()
-               .reset_index(name="Turnos Utilizados")
-               .sort_values("Turnos Utilizados", ascending=False)
-               .head(15))
+    # ordenação estável sobre a ordem das categorias: empates continuam em ordem alfabética
+    contagem = fdf.loc[fdf["Ocupado"], "Médico"].value_counts(sort=False).sort_values(ascending=False, kind="stable")
+    top_med = (contagem[contagem > 0]  # categorias sem uso também aparecem no value_counts
+               .head(15)
+               .rename_axis("Médico")
+               .reset_index(name="Turnos Utilizados"))
     if not top_med.empty:
-        fig4 = px.bar(top_med, x="Turnos Utilizados", y="Médico", orientation="h", title="Top Médicos por Nº de Turnos", text="Turnos Utilizados")
-        fig4.update_traces(textposition="outside")
+        fig4 = _bar(top_med, "Turnos Utilizados", "Médico", "Top Médicos por Nº de Turnos", horizontal=True)
         st.plotly_chart(fig4, use_container_width=True)
     else:
         st.info("Sem médicos ocupando slots nos filtros atuais.")
 
-# ---------- Integração das abas MÉDICOS (1, 2, 3...) ----------
-def _to_number(x):
-    import numpy as np, re as _re
-    if pd.isna(x):
-        return np.nan
-    txt = str(x)
-    txt = _re.sub(r"[^\d,.-]", "", txt)
-    if "," in txt and "." in txt:
-        txt = txt.replace(".", "").replace(",", ".")
-    elif "," in txt and "." not in txt:
-        txt = txt.replace(",", ".")
-    try:
-        return float(txt)
-    except:
-        return pd.NA
-
-def load_medicos_from_excel(excel: pd.ExcelFile):
-    frames = []
-    for s in excel.sheet_names:
-        sn = _normalize_col(s)
-        if "medic" in sn:  # captura "médicos", "medicos"
-            try:
-                dfm = excel.parse(s, header=0)
-            except Exception:
-                continue
-            if dfm is None or dfm.empty:
-                continue
-            # normaliza colunas
-            norm = {c:_normalize_col(c) for c in dfm.columns}
-            dfm.columns = [norm[c] for c in dfm.columns]
-            rename = {}
-            for c in dfm.columns:
-                if "nome" in c or "medico" in c: rename[c]="Médico"
-                if c=="crm" or "crm" in c: rename[c]="CRM"
-                if "especial" in c: rename[c]="Especialidade"
-                if "planos" in c or c=="plano": rename[c]="Planos"
-                if "valor" in c or "aluguel" in c or "negoci" in c: rename[c]="Valor Aluguel"
-                if "exclus" in c: rename[c]="Sala Exclusiva"
-                if "divid" in c: rename[c]="Sala Dividida"
-            dfm = dfm.rename(columns=rename)
-            keep = [c for c in ["Médico","CRM","Especialidade","Planos","Sala Exclusiva","Sala Dividida","Valor Aluguel"] if c in dfm.columns]
-            if not keep:
-                continue
-            dfm = dfm[keep].copy()
-            frames.append(dfm)
-    if not frames:
-        return pd.DataFrame()
-    out = pd.concat(frames, ignore_index=True)
-    # normalizações finais
-    if "Médico" in out.columns: out["Médico"] = out["Médico"].astype(str).str.strip()
-    if "Planos" in out.columns: out["Planos"] = out["Planos"].astype(str).str.strip()
-    if "Valor Aluguel" in out.columns: out["Valor Aluguel"] = out["Valor Aluguel"].apply(_to_number)
-    for c in ["Sala Exclusiva","Sala Dividida"]:
-        if c in out.columns:
-            out[c] = out[c].astype(str).str.strip().str.upper().replace({"X":"Sim","":""})
-    return out
-
-med_df = load_medicos_from_excel(excel)
-
 if med_df.empty:
     st.warning("Não foram encontradas abas de **MÉDICOS** no arquivo. Os indicadores de plano/aluguel ficarão ocultos.")
 else:
     # Enriquecer com turnos utilizados
-    usos = fdf_base.groupby("Médico").size().reset_index(name="Turnos Utilizados")
-    med_enriched = med_df.merge(usos, on="Médico", how="left")
+    usos = fdf_base["Médico"].value_counts(sort=False)
+    usos = usos[usos > 0].rename_axis("Médico").reset_index(name="Turnos Utilizados")
+    med_enriched, aggs = enrich_medicos(med_df, usos)
 
     st.markdown("---")
     st.subheader("💼 Indicador: PLANOS × Aluguel × Profissionais")
@@ -290,48 +488,38 @@ else:
 
     g1, g2 = st.columns(2)
     with g1:
-        if "Planos" in med_enriched.columns:
-            cont = med_enriched.groupby("Planos")["Médico"].nunique().reset_index(name="Profissionais")
-            fig7 = px.bar(cont, x="Planos", y="Profissionais", title="Profissionais por PLANOS", text="Profissionais")
-            fig7.update_traces(textposition="outside")
+        if "cont" in aggs:
+            fig7 = _bar(aggs["cont"], "Planos", "Profissionais", "Profissionais por PLANOS")
             st.plotly_chart(fig7, use_container_width=True)
         else:
             st.info("Coluna PLANOS não encontrada.")
 
     with g2:
-        if "Valor Aluguel" in med_enriched.columns and "Planos" in med_enriched.columns:
-            avgv = med_enriched.groupby("Planos")["Valor Aluguel"].mean().reset_index(name="Valor médio (R$)")
-            avgv["Valor médio (R$)"] = avgv["Valor médio (R$)"].round(2)
-            fig8 = px.bar(avgv, x="Planos", y="Valor médio (R$)", title="Valor médio de aluguel por PLANOS", text="Valor médio (R$)")
-            fig8.update_traces(texttemplate="R$ %{y:.2f}", textposition="outside")
+        if "avgv" in aggs:
+            fig8 = _bar(aggs["avgv"], "Planos", "Valor médio (R$)", "Valor médio de aluguel por PLANOS", texttemplate="R$ %{y:.2f}")
             st.plotly_chart(fig8, use_container_width=True)
         else:
             st.info("Inclua as colunas PLANOS e Valor Aluguel.")
 
-    if "Valor Aluguel" in med_enriched.columns:
+    if "dist" in aggs:
         st.markdown("##### Distribuição de profissionais por faixa de aluguel × PLANOS")
-        bins = [0,500,1000,1500,2000,3000,9999999]
-        labels = ["até 500","501–1000","1001–1500","1501–2000","2001–3000","3000+"]
-        med_enriched["Faixa Aluguel"] = pd.cut(med_enriched["Valor Aluguel"], bins=bins, labels=labels, include_lowest=True)
-        dist = med_enriched.groupby(["Planos","Faixa Aluguel"])["Médico"].nunique().reset_index(name="Profissionais")
-        fig9 = px.bar(dist, x="Faixa Aluguel", y="Profissionais", color="Planos", barmode="group",
+        # com observed=True cada trace só traz as faixas usadas: fixa a ordem do eixo pelas faixas
+        fig9 = px.bar(aggs["dist"], x="Faixa Aluguel", y="Profissionais", color="Planos", barmode="group",
+                      category_orders={"Faixa Aluguel": FAIXA_LABELS},
                       title="Profissionais por faixa de aluguel × PLANOS", text="Profissionais")
         fig9.update_traces(textposition="outside")
         st.plotly_chart(fig9, use_container_width=True)
 
     g3, g4 = st.columns(2)
     with g3:
-        if "Especialidade" in med_enriched.columns and "Valor Aluguel" in med_enriched.columns:
-            esp_avg = med_enriched.groupby("Especialidade")["Valor Aluguel"].mean().reset_index(name="Valor médio (R$)").sort_values("Valor médio (R$)", ascending=False)
-            fig10 = px.bar(esp_avg, x="Valor médio (R$)", y="Especialidade", orientation="h", title="Valor médio de aluguel por especialidade", text="Valor médio (R$)")
-            fig10.update_traces(texttemplate="R$ %{x:.2f}", textposition="outside")
+        if "esp_avg" in aggs:
+            fig10 = _bar(aggs["esp_avg"], "Valor médio (R$)", "Especialidade", "Valor médio de aluguel por especialidade", texttemplate="R$ %{x:.2f}", horizontal=True)
             st.plotly_chart(fig10, use_container_width=True)
         else:
             st.info("Inclua 'Especialidade' e 'Valor Aluguel'.")
     with g4:
-        if "Planos" in med_enriched.columns and "Especialidade" in med_enriched.columns:
-            plano_esp = med_enriched.groupby(["Especialidade","Planos"])["Médico"].nunique().reset_index(name="Profissionais")
-            fig11 = px.bar(plano_esp, x="Especialidade", y="Profissionais", color="Planos", barmode="group",
+        if "plano_esp" in aggs:
+            fig11 = px.bar(aggs["plano_esp"], x="Especialidade", y="Profissionais", color="Planos", barmode="group",
                            title="Profissionais por especialidade × PLANOS", text="Profissionais")
             fig11.update_traces(textposition="outside")
             st.plotly_chart(fig11, use_container_width=True)
@@ -340,18 +528,9 @@ else:
 
     g5, g6 = st.columns(2)
     with g5:
-        if "Sala Exclusiva" in med_enriched.columns or "Sala Dividida" in med_enriched.columns:
-            ts = med_enriched.copy()
-            ts["Tipo de Sala"] = None
-            if "Sala Exclusiva" in ts.columns:
-                ts.loc[ts["Sala Exclusiva"].eq("Sim"), "Tipo de Sala"] = "Exclusiva"
-            if "Sala Dividida" in ts.columns:
-                ts.loc[ts["Sala Dividida"].eq("Sim"), "Tipo de Sala"] = ts["Tipo de Sala"].fillna("Dividida")
-            ts = ts.dropna(subset=["Tipo de Sala"])
-            if not ts.empty:
-                dist_ts = ts.groupby("Tipo de Sala")["Médico"].nunique().reset_index(name="Profissionais")
-                fig12 = px.bar(dist_ts, x="Tipo de Sala", y="Profissionais", title="Profissionais por tipo de sala", text="Profissionais")
-                fig12.update_traces(textposition="outside")
+        if "dist_ts" in aggs:
+            if not aggs["dist_ts"].empty:
+                fig12 = _bar(aggs["dist_ts"], "Tipo de Sala", "Profissionais", "Profissionais por tipo de sala")
                 st.plotly_chart(fig12, use_container_width=True)
             else:
                 st.info("Sem marcações de sala exclusiva/dividida para analisar.")
@@ -364,54 +543,6 @@ else:
 
 # ==================== NOVOS BLOCOS ====================
 # ---------- PRODUTIVIDADE CONSULTÓRIO (1, 2, 3) ----------
-def load_produtividade_from_excel(excel: pd.ExcelFile):
-    frames = []
-    for s in excel.sheet_names:
-        sn = _normalize_col(s)
-        if "produtividade" in sn and "consultorio" in sn:
-            # Tenta ler com header na primeira linha
-            try:
-                dfp = excel.parse(s, header=0)
-            except Exception:
-                continue
-            if dfp is None or dfp.empty:
-                continue
-
-            # Normaliza colunas
-            norm_map = {c: _normalize_col(c) for c in dfp.columns}
-            dfp.columns = [norm_map[c] for c in dfp.columns]
-
-            rename = {}
-            for c in dfp.columns:
-                if "nome" in c: rename[c] = "NOME"
-                elif c == "crm" or "crm" in c: rename[c] = "CRM"
-                elif "especial" in c: rename[c] = "ESPECIALIDADE"
-                elif "exame" in c: rename[c] = "EXAMES SOLICITADOS"
-                elif "cirurg" in c: rename[c] = "CIRURGIAS SOLICITADAS"
-            dfp = dfp.rename(columns=rename)
-
-            keep = [c for c in ["NOME","CRM","ESPECIALIDADE","EXAMES SOLICITADOS","CIRURGIAS SOLICITADAS"] if c in dfp.columns]
-            if not keep:
-                continue
-            dfp = dfp[keep].copy()
-
-            # Tipos numéricos para métricas
-            for c in ["EXAMES SOLICITADOS","CIRURGIAS SOLICITADAS"]:
-                if c in dfp.columns:
-                    dfp[c] = pd.to_numeric(dfp[c], errors="coerce").fillna(0)
-
-            # Extrai nº do consultório do nome da aba
-            m = re.search(r"(\d+)", s)
-            consultorio = f"Consultório {m.group(1)}" if m else s
-            dfp.insert(0, "Consultório", consultorio)
-            frames.append(dfp)
-
-    if not frames:
-        return pd.DataFrame(columns=["Consultório","NOME","CRM","ESPECIALIDADE","EXAMES SOLICITADOS","CIRURGIAS SOLICITADAS"])
-    return pd.concat(frames, ignore_index=True)
-
-prod_df = load_produtividade_from_excel(excel)
-
 if not prod_df.empty:
     st.markdown("---")
     st.subheader("🧪 Produtividade por Consultório (Exames × Cirurgias)")
@@ -517,45 +648,6 @@ if not prod_df.empty:
                  use_container_width=True)
 
 # ---------- CONSULTAS MARCADAS (BLOCO INDIVIDUAL) ----------
-def load_consultas_marcadas(excel: pd.ExcelFile):
-    target_name = None
-    for s in excel.sheet_names:
-        if _normalize_col(s) == "consultas marcadas":
-            target_name = s
-            break
-    if target_name is None:
-        # tenta contém
-        for s in excel.sheet_names:
-            if "consulta" in _normalize_col(s) and "marcada" in _normalize_col(s):
-                target_name = s
-                break
-    if target_name is None:
-        return pd.DataFrame(columns=["Especialidade","Quantidade"])
-
-    dfc = excel.parse(target_name, header=0)
-    if dfc is None or dfc.empty:
-        return pd.DataFrame(columns=["Especialidade","Quantidade"])
-
-    # Normaliza colunas
-    cols_map = {c:_normalize_col(c) for c in dfc.columns}
-    dfc.columns = [cols_map[c] for c in dfc.columns]
-    rename = {}
-    for c in dfc.columns:
-        if "especial" in c: rename[c] = "Especialidade"
-        elif "quant" in c: rename[c] = "Quantidade"
-    dfc = dfc.rename(columns=rename)
-
-    keep = [c for c in ["Especialidade","Quantidade"] if c in dfc.columns]
-    if not keep:
-        return pd.DataFrame(columns=["Especialidade","Quantidade"])
-    dfc = dfc[keep].copy()
-    dfc["Quantidade"] = pd.to_numeric(dfc["Quantidade"], errors="coerce").fillna(0).astype(int)
-    dfc["Especialidade"] = dfc["Especialidade"].astype(str).str.strip()
-    dfc = dfc[dfc["Especialidade"].str.len()>0]
-    return dfc
-
-cons_df = load_consultas_marcadas(excel)
-
 if not cons_df.empty:
     st.markdown("---")
     st.subheader("📅 Consultas Marcadas — Bloco Individual")
@@ -612,5 +704,6 @@ st.dataframe(
     fdf.sort_values(["Sala","Dia","Turno"]).reset_index(drop=True)[["Sala","Dia","Turno","Médico"]],
     use_container_width=True
 )
-csv = fdf.to_csv(index=False).encode("utf-8-sig")
+
+csv = _to_csv_bytes(fdf)
 st.download_button("⬇️ Baixar dados filtrados (CSV)", data=csv, file_name="agenda_filtrada.csv", mime="text/csv")